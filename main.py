@@ -1,10 +1,58 @@
 import asyncio
 import aiohttp
-from tenacity import retry, wait_exponential, stop_after_attempt, RetryError
+import hashlib
 import os
+import re
 import json
+import shelve
+from collections import defaultdict
 from datetime import datetime, timedelta
+import matplotlib
+# Render plots without a GUI backend; the plot is only saved to a file
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import numpy as np
+
+# Use orjson for decoding responses when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Pattern for the total hit count in a Europe PMC citations response
+HIT_COUNT_RE = re.compile(rb'<hitCount>(\d+)</hitCount>')
+
+# Buffer size for output files written while fetches are in flight, so the
+# event loop is rarely blocked on a disk write
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Request settings shared by every annotations/citations call
+ANNOTATIONS_URL = "https://www.ebi.ac.uk/europepmc/annotations_api/annotationsByArticleIds"
+ANNOTATIONS_PARAMS = {
+    'type': 'Accession Numbers',
+    'subType': 'bioproject',
+    'format': 'JSON'
+}
+ANNOTATIONS_HEADERS = {
+    'Accept': 'application/json'
+}
+CITATIONS_PARAMS = {
+    'page': 1,
+    # Only hitCount is read, so keep the citation list itself minimal
+    'pageSize': 1,
+    'format': 'xml'
+}
+CITATIONS_HEADERS = {
+    'Accept': 'application/xml'
+}
+
+# Errors that are worth retrying a request for
+RETRY_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# Errors that make a single PMID be reported and skipped rather than failing the
+# run; ValueError covers a response body that does not decode
+SKIP_ERRORS = RETRY_ERRORS + (ValueError,)
 
 # Function to read the configuration file
 def read_config(config_file):
@@ -12,137 +60,136 @@ def read_config(config_file):
         config = json.load(file)
     return config
 
-# Function to read PMIDs from the file
+# Function to read PMIDs from the file, dropping blank lines and duplicates
 def read_pmids(file_path):
     with open(file_path, 'r') as file:
-        pmids = [line.strip() for line in file.readlines()]
+        # PMIDs never contain whitespace, so split() also drops blank lines
+        pmids = list(dict.fromkeys(file.read().split()))
     return pmids
 
-# Function to fetch annotations for a given PMID with retries
-@retry(wait=wait_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5))
+# Function to wrap a fetch function with retries and exponential backoff;
+# the last error is re-raised once all tries are used up
+def with_retry(fetch, tries=5, base=4, cap=60):
+    async def fetch_with_retry(session, pmid):
+        for attempt in range(tries - 1):
+            try:
+                return await fetch(session, pmid)
+            except RETRY_ERRORS:
+                await asyncio.sleep(min(cap, base * 2 ** attempt))
+        return await fetch(session, pmid)
+    return fetch_with_retry
+
+# Function to fetch the raw annotations response for a given PMID with retries
+@with_retry
 async def fetch_annotations(session, pmid):
-    url = f"https://www.ebi.ac.uk/europepmc/annotations_api/annotationsByArticleIds"
-    params = {
-        'articleIds': f'MED:{pmid}',
-        'type': 'Accession Numbers',
-        'subType': 'bioproject',
-        'format': 'JSON'
-    }
-    headers = {
-        'Accept': 'application/json'
-    }
-
-    async with session.get(url, headers=headers, params=params, timeout=60) as response:
+    params = {**ANNOTATIONS_PARAMS, 'articleIds': f'MED:{pmid}'}
+
+    async with session.get(ANNOTATIONS_URL, headers=ANNOTATIONS_HEADERS, params=params) as response:
         if response.status == 200:
-            return await response.json()
+            return await response.read()
         else:
             print(f"Error fetching annotations for PMID {pmid}: {response.status}")
             return None
 
 # Function to extract 'name' values from the annotations
 def extract_names(annotations):
-    names = []
-    for annotation in annotations:
-        for ann in annotation.get('annotations', []):
-            names.extend([tag['name'] for tag in ann.get('tags', [])])
-    return names
+    return [tag['name']
+            for annotation in annotations
+            for ann in annotation.get('annotations', ())
+            for tag in ann.get('tags', ())]
 
-# Function to write the PMIDs and their corresponding names to a file
-def write_results(file_path, results):
-    with open(file_path, 'w') as file:
-        for pmid, names in results.items():
-            names_str = ', '.join(names)
-            file.write(f"{pmid}: {names_str}\n")
+# Function to extract names from a raw annotations response, cached by a hash of
+# its contents so an unchanged response is never parsed twice; a body that is
+# not valid JSON raises ValueError and is not cached
+def extract_names_cached(cache, raw_annotations):
+    key = 'names:' + hashlib.blake2b(raw_annotations, digest_size=16).hexdigest()
+    entry = read_cache_entry(cache, key)
+    names = entry[1] if entry is not None else extract_names(json_loads(raw_annotations))
+    # Stamp the entry on every use so prune_cache only drops unused ones
+    cache[key] = (datetime.now(), names)
+    return names
 
 # Function to fetch citation count for a given PMID with retries
-@retry(wait=wait_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5))
+@with_retry
 async def fetch_citation_count(session, pmid):
     url = f"https://www.ebi.ac.uk/europepmc/webservices/rest/MED/{pmid}/citations"
-    params = {
-        'page': 1,
-        'pageSize': 25,
-        'format': 'xml'
-    }
-    headers = {
-        'Accept': 'application/xml'
-    }
-
-    async with session.get(url, headers=headers, params=params, timeout=60) as response:
+
+    async with session.get(url, headers=CITATIONS_HEADERS, params=CITATIONS_PARAMS) as response:
         if response.status == 200:
-            text = await response.text()
-            start = text.find('<hitCount>') + len('<hitCount>')
-            end = text.find('</hitCount>')
-            hit_count = int(text[start:end])
-            return hit_count
+            match = HIT_COUNT_RE.search(await response.read())
+            if match is None:
+                print(f"No hit count in citations response for PMID {pmid}")
+                return None
+            return int(match.group(1))
         else:
             print(f"Error fetching citation count for PMID {pmid}: {response.status}")
             return None
 
-# Function to write the citation counts to a file
-def write_citation_counts(file_path, citation_counts):
-    with open(file_path, 'w') as file:
-        for pmid, count in citation_counts.items():
-            file.write(f"{pmid}: {count}\n")
+# Function to yield the raw lines of a file (newline included) as bytes, so
+# only the fields that are kept get decoded
+def read_lines_bytes(file_path):
+    with open(file_path, 'rb') as file:
+        yield from file
 
 # Function to map citation counts to unique names and write to a file
 def write_names_with_citation_counts(names_file, citation_counts_file, output_file):
     # Read the unique names from the names file
+    # (PMIDs are only used as keys here, so they stay as bytes)
     pmid_to_names = {}
-    with open(names_file, 'r') as file:
-        for line in file:
-            try:
-                pmid, names_str = line.strip().split(': ')
-                names = [name.strip() for name in names_str.split(',')]
-                pmid_to_names[pmid] = names
-            except ValueError:
-                print(f"Skipping line due to format issue in names file: {line}")
+    for line in read_lines_bytes(names_file):
+        pmid, sep, names_str = line.strip().partition(b': ')
+        if not sep:
+            print(f"Skipping line due to format issue in names file: {line.decode()}")
+            continue
+        pmid_to_names[pmid] = [name.strip() for name in names_str.decode().split(',')]
 
     # Read the citation counts from the citation counts file
     pmid_to_citation_count = {}
-    with open(citation_counts_file, 'r') as file:
-        for line in file:
-            try:
-                pmid, count = line.strip().split(': ')
-                pmid_to_citation_count[pmid] = int(count)
-            except ValueError:
-                print(f"Skipping line due to format issue in citation counts file: {line}")
+    for line in read_lines_bytes(citation_counts_file):
+        pmid, sep, count = line.strip().partition(b': ')
+        if not sep or not count.isdigit():
+            print(f"Skipping line due to format issue in citation counts file: {line.decode()}")
+            continue
+        pmid_to_citation_count[pmid] = int(count)
 
     # Map the citation counts to the unique names
-    names_to_citation_counts = {}
+    names_to_citation_counts = defaultdict(int)
     for pmid, names in pmid_to_names.items():
-        if pmid in pmid_to_citation_count:
-            count = pmid_to_citation_count[pmid]
+        count = pmid_to_citation_count.get(pmid)
+        if count is not None:
             for name in names:
-                if name not in names_to_citation_counts:
-                    names_to_citation_counts[name] = 0
                 names_to_citation_counts[name] += count
 
     # Write the names and their corresponding citation counts to the output file
-    with open(output_file, 'w') as file:
-        for name, count in names_to_citation_counts.items():
-            file.write(f"{name}: {count}\n")
+    with open(output_file, 'w', encoding='utf-8') as file:
+        file.write(''.join(f"{name}: {count}\n" for name, count in names_to_citation_counts.items()))
 
 # Function to create a plot from the names with citation counts file
 def create_plot(file_path):
     names = []
     counts = []
-    with open(file_path, 'r') as file:
-        for line in file:
-            name, count = line.strip().split(': ')
-            names.append(name)
-            counts.append(int(count))
+    for line in read_lines_bytes(file_path):
+        name, _, count = line.strip().rpartition(b': ')
+        names.append(name.decode())
+        counts.append(int(count))
 
-    # Sort by counts
-    sorted_data = sorted(zip(names, counts), key=lambda x: x[1], reverse=True)
-    top_100_data = sorted_data[:100]
-    plot_names, plot_counts = zip(*top_100_data)
+    # Select the top 100 by counts without sorting the whole list: keep every
+    # entry at or above the 100th-largest count, then sort only those by count
+    # and then name. The file is written in fetch completion order, so ties
+    # (including at the cut-off) are broken by name to keep the plot stable
+    counts = np.fromiter(counts, dtype=np.int64, count=len(counts))
+    top_n = min(100, len(counts))
+    threshold = -np.partition(-counts, top_n - 1)[top_n - 1]
+    candidates = np.flatnonzero(counts >= threshold)
+    top_idx = sorted(candidates, key=lambda i: (-counts[i], names[i]))[:top_n]
+    plot_names = [names[i] for i in top_idx]
+    plot_counts = counts[top_idx]
 
     # Write names being plotted to a new file
-    with open('citation_top_100_names.txt', 'w') as file:
-        for name in plot_names:
-            file.write(f"{name}\n")
+    with open('citation_top_100_names.txt', 'w', encoding='utf-8') as file:
+        file.write(''.join(f"{name}\n" for name in plot_names))
 
-    plt.figure(figsize=(15, 10))
+    fig = plt.figure(figsize=(15, 10))
     plt.bar(plot_names, plot_counts, color='skyblue')
     plt.xticks(rotation=90)
     plt.ylabel('Citation Count')
@@ -150,7 +197,78 @@ def create_plot(file_path):
     plt.title('Top 100 Citation Counts by Names')
     plt.tight_layout()
     plt.savefig('names_with_citation_counts_plot.png')
-    plt.show()
+    plt.close(fig)
+
+# Function to read a (timestamp, value) cache entry, returning None if the key is
+# missing or holds anything else, such as a bare value from an earlier layout
+def read_cache_entry(cache, key):
+    entry = cache.get(key)
+    if isinstance(entry, tuple) and len(entry) == 2 and isinstance(entry[0], datetime):
+        return entry
+    return None
+
+# Function to wrap a fetch function with a per-PMID on-disk cache that expires after max_age
+def cached_fetch(fetch, cache, kind, max_age):
+    async def fetch_with_cache(session, pmid):
+        key = f"{kind}:{pmid}"
+        entry = read_cache_entry(cache, key)
+        if entry is not None and datetime.now() - entry[0] < max_age:
+            return entry[1]
+        result = await fetch(session, pmid)
+        if result is not None:
+            cache[key] = (datetime.now(), result)
+        return result
+    return fetch_with_cache
+
+# Function to drop expired or unreadable entries so the cache file does not
+# keep growing
+def prune_cache(cache, max_age):
+    now = datetime.now()
+    for key in list(cache.keys()):
+        entry = read_cache_entry(cache, key)
+        # Names by payload hash are looked up only when a PMID entry has
+        # expired, so they are kept for twice as long
+        entry_max_age = 2 * max_age if key.startswith('names:') else max_age
+        if entry is None or now - entry[0] >= entry_max_age:
+            del cache[key]
+
+# Function to fetch data for a PMID, returning None if it fails after retries
+# or its response cannot be decoded
+async def try_fetch(fetch, session, pmid):
+    try:
+        return await fetch(session, pmid)
+    except SKIP_ERRORS as e:
+        print(f"Failed to fetch data for PMID {pmid}: {e!r}")
+        return None
+
+# Function to fetch data for every PMID using a fixed pool of worker tasks,
+# yielding (pmid, result) pairs in the order they complete; an unexpected
+# error in a worker is re-raised here instead of leaving the loop waiting
+async def fetch_all(session, fetch, pmids, num_workers):
+    in_queue = asyncio.Queue()
+    for pmid in pmids:
+        in_queue.put_nowait(pmid)
+    out_queue = asyncio.Queue()
+
+    async def worker():
+        while True:
+            pmid = await in_queue.get()
+            try:
+                await out_queue.put((pmid, await fetch(session, pmid), None))
+            except Exception as e:
+                await out_queue.put((pmid, None, e))
+
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+    try:
+        for _ in range(len(pmids)):
+            pmid, result, error = await out_queue.get()
+            if error is not None:
+                raise error
+            yield pmid, result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 # Main script
 async def main():
@@ -158,12 +276,15 @@ async def main():
     config = read_config(config_file)
     fetch_data = config.get('fetch_data', True)
     plot_data = config.get('plot_data', True)
+    concurrency = config.get('concurrency', 15)
+    cache_max_age = timedelta(days=config.get('cache_days', 7))
 
     input_file = 'pmids.txt'
     output_file = 'pmids_with_names.txt'
     unique_names_count_file = 'unique_names_count.txt'
     citation_counts_file = 'pmid_citation_counts.txt'
     names_with_citation_counts_file = 'names_with_citation_counts.txt'
+    cache_file = 'fetch_cache'
 
     # Read PMIDs from the file
     pmids = read_pmids(input_file)
@@ -172,34 +293,47 @@ async def main():
     if fetch_data:
         print("Fetching new data...")
 
-        # Fetch and write PMIDs with names
-        results = {}
-        try:
-            async with aiohttp.ClientSession() as session:
-                tasks = [fetch_annotations(session, pmid) for pmid in pmids]
-                annotations_list = await asyncio.gather(*tasks)
-            for pmid, annotations in zip(pmids, annotations_list):
-                if annotations:
-                    names = extract_names(annotations)
-                    results[pmid] = names
-            write_results(output_file, results)
+        # Share one session (and its connection pool) across all requests; both
+        # connection limits follow the configured concurrency
+        connector = aiohttp.TCPConnector(limit=max(20, concurrency), limit_per_host=concurrency, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=60)
+        # Reuse results fetched on earlier runs until they expire
+        with shelve.open(cache_file) as cache:
+            prune_cache(cache, cache_max_age)
+
+            # Fetch the annotations of a PMID and extract their names, so only
+            # responses that decode end up in the cache
+            async def fetch_names(session, pmid):
+                raw_annotations = await fetch_annotations(session, pmid)
+                if raw_annotations is None:
+                    return None
+                return extract_names_cached(cache, raw_annotations)
+
+            fetch_names_cached = cached_fetch(fetch_names, cache, 'pmid_names', cache_max_age)
+            fetch_citation_count_cached = cached_fetch(fetch_citation_count, cache, 'citations', cache_max_age)
+
+            # Fetch the names and the citation count of a PMID together; if one
+            # fails unexpectedly the task group cancels the other
+            async def fetch_pmid(session, pmid):
+                async with asyncio.TaskGroup() as group:
+                    names = group.create_task(try_fetch(fetch_names_cached, session, pmid))
+                    count = group.create_task(try_fetch(fetch_citation_count_cached, session, pmid))
+                return names.result(), count.result()
+
+            # Each worker has two requests in flight at a time
+            num_workers = max(1, concurrency // 2)
+
+            # Fetch PMIDs with names and citation counts, writing each one as soon as it arrives
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                with open(output_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as names_file, \
+                        open(citation_counts_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as counts_file:
+                    async for pmid, (names, count) in fetch_all(session, fetch_pmid, pmids, num_workers):
+                        if names:
+                            names_file.write(f"{pmid}: {', '.join(names)}\n")
+                        if count is not None:
+                            counts_file.write(f"{pmid}: {count}\n")
             print(f"Results written to {output_file}")
-        except RetryError as e:
-            print(f"Failed to fetch annotations after retries: {e}")
-
-        # Fetch and write citation counts
-        citation_counts = {}
-        try:
-            async with aiohttp.ClientSession() as session:
-                tasks = [fetch_citation_count(session, pmid) for pmid in pmids]
-                citation_counts_list = await asyncio.gather(*tasks)
-            for pmid, count in zip(pmids, citation_counts_list):
-                if count is not None:
-                    citation_counts[pmid] = count
-            write_citation_counts(citation_counts_file, citation_counts)
             print(f"Citation counts written to {citation_counts_file}")
-        except RetryError as e:
-            print(f"Failed to fetch citation counts after retries: {e}")
     else:
         print("Using existing data...")
 